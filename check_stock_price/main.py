@@ -1,20 +1,25 @@
-import json
+import asyncio
+import functools
 import logging
 import math
 import os
 import pathlib
 import subprocess
-from dataclasses import dataclass
-from typing import Optional, Sequence
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, fields, replace
+from typing import TYPE_CHECKING, Optional, Sequence
 
-import boto3
-import pendulum
-import requests
+import orjson
 import typer
 from rich import print
-from tabulate import SEPARATING_LINE, tabulate
 from typing_extensions import Annotated
 
+# Heavy dependencies are imported where they are used so the CLI starts fast
+if TYPE_CHECKING:
+    import aiohttp
+    import boto3
+
 logger = logging.getLogger('check_stock_price')
 handler = logging.FileHandler('check_stock_price.log')
 formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
@@ -24,8 +29,22 @@ logger.setLevel(logging.INFO)
 
 app = typer.Typer()
 
+# Number of AlphaVantage requests in flight at once, this does not enforce a per-minute rate limit
+ALPHAVANTAGE_MAX_CONCURRENT_REQUESTS = 5
+ALPHAVANTAGE_TIMEOUT_SECONDS = 10
+# Only transport errors and these HTTP statuses are retried, AlphaVantage rate limit notes come back as
+# HTTP 200 and are handled by keeping the existing local data
+ALPHAVANTAGE_MAX_RETRIES = 5
+ALPHAVANTAGE_RETRY_BACKOFF_SECONDS = 0.5
+ALPHAVANTAGE_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# BatchWriteItem accepts at most 25 items per request
+DYNAMODB_MAX_BATCH_WRITE_ITEMS = 25
+
+STOCK_SUMMARY_KEYS = {'latest_ts', 'latest_close', 'prev_close'}
 
-@dataclass
+
+@dataclass(slots=True, frozen=True)
 class Parameters:
     target_account_balance: float
     threshold_data_age_minutes: int
@@ -34,17 +53,34 @@ class Parameters:
     alphavantage_api_key: str
 
 
+@functools.lru_cache(maxsize=256)
+def calculate_investment_dollars(
+    account_balance: float, target_account_balance: float, investment_aggression: float, percentage_change: float
+) -> float:
+    difference = account_balance - target_account_balance
+    percent_over = difference / target_account_balance
+    multiplier = difference * math.exp(percent_over) * investment_aggression
+    dollars = multiplier * abs(percentage_change**2)
+    return dollars
+
+
 class RoboInvestor:
-    def __init__(self, boto_session: boto3.Session, account_balance=10_000.00):
-        self.dynamo = boto_session.resource('dynamodb')
-        self.table = self.dynamo.Table('stocks')
+    __slots__ = ('dynamo_client', 'ssm', 'parameters', 'tickers', 'account_balance')
+
+    def __init__(self, boto_session: 'boto3.Session', account_balance=10_000.00):
+        # Low level client uses raw attribute values, skipping the resource (de)serializer
+        self.dynamo_client = boto_session.client('dynamodb')
         self.ssm = boto_session.client('ssm')
         self.parameters = self.load_parameters_from_parameter_store()
         self.tickers = self.load_tickers_from_dynamodb()
         self.account_balance = account_balance
 
     def load_parameters_from_parameter_store(self):
-        response = self.ssm.get_parameters_by_path(Path='/robo-investor/', WithDecryption=True)
+        # Request exactly the known names in one call, get_parameters_by_path pages after 10 results
+        names = [f'/robo-investor/{field.name}' for field in fields(Parameters)]
+        response = self.ssm.get_parameters(Names=names, WithDecryption=True)
+        if response['InvalidParameters']:
+            logger.error(f'Missing from parameter store: {response["InvalidParameters"]}')
         params = {}
         for param in response['Parameters']:
             _prefix, name = param['Name'].rsplit('/', maxsplit=1)
@@ -63,63 +99,179 @@ class RoboInvestor:
 
     def save_parameters_to_parameter_store(self, parameters: dict[str, str | int | float]):
         prefix = '/robo-investor/'
-        for name, value in parameters.items():
+
+        def put_parameter(name, value):
             logger.info(f'Saving {name}: {value} to parameter store')
             self.ssm.put_parameter(Name=prefix + name, Value=value, Type='SecureString', Overwrite=True)
 
-    def request_api_stock_data(self, ticker):
-        return requests.get(
-            f'https://www.alphavantage.co/query?function=TIME_SERIES_INTRADAY'
-            f'&symbol={ticker}&interval=5min&apikey={self.parameters.alphavantage_api_key}'
-        ).json()
+        # SSM has no batch put, the client is thread-safe so the independent writes are sent concurrently
+        with ThreadPoolExecutor(max_workers=len(parameters) or 1) as executor:
+            list(executor.map(put_parameter, parameters.keys(), parameters.values()))
+
+    def api_stock_data_url(self, ticker):
+        return (
+            f'https://www.alphavantage.co/query?function=GLOBAL_QUOTE'
+            f'&symbol={ticker}&apikey={self.parameters.alphavantage_api_key}'
+        )
+
+    async def _fetch_api(self, ticker, session: 'aiohttp.ClientSession', semaphore: asyncio.Semaphore):
+        import aiohttp
+
+        url = self.api_stock_data_url(ticker)
+        for attempt in range(ALPHAVANTAGE_MAX_RETRIES + 1):
+            last_attempt = attempt == ALPHAVANTAGE_MAX_RETRIES
+            async with semaphore:
+                logger.info(f'{ticker}: Requesting data from API')
+                try:
+                    async with session.get(url) as response:
+                        if last_attempt or response.status not in ALPHAVANTAGE_RETRY_STATUSES:
+                            response.raise_for_status()
+                            data = await response.json()
+                            break
+                        reason = f'HTTP {response.status}'
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as error:
+                    if last_attempt:
+                        raise
+                    reason = repr(error)
+            # Back off without holding a request slot
+            backoff = ALPHAVANTAGE_RETRY_BACKOFF_SECONDS * 2**attempt
+            logger.warning(f'{ticker}: Request failed with {reason}, retrying in {backoff} seconds')
+            await asyncio.sleep(backoff)
+        self.save_stock_data_to_local(ticker, data)
+        return data
 
     def save_stock_data_to_local(self, ticker, data):
+        # Error responses such as rate limit notes have no quote, keep the existing local data instead
+        try:
+            summary = self.summarize_stock_data(data)
+        except (KeyError, ValueError):
+            logger.warning(f'{ticker}: Unexpected data format, not saving: {data}')
+            return
+
         file_path = pathlib.Path(f'data/{ticker}.json')
         file_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(file_path, 'w') as f:
-            json.dump(data, f)
+        file_path.write_bytes(orjson.dumps(data))
 
-    def load_stock_data_from_local(self, ticker):
-        file_path = pathlib.Path(f'data/{ticker}.json')
-        with open(file_path) as f:
-            return json.load(f)
+        # Sidecar with only the values check_stock_prices needs, so it doesn't parse the full data
+        summary_path = pathlib.Path(f'data/{ticker}.summary.json')
+        summary_path.write_bytes(orjson.dumps(summary))
 
-    def load_or_request_data(self, ticker, threshold_minutes: Optional[int] = None):
-        threshold_minutes = threshold_minutes or self.parameters.threshold_data_age_minutes
+    def load_stock_data_from_local(self, ticker):
         file_path = pathlib.Path(f'data/{ticker}.json')
-        if not file_path.exists():
-            logger.info(f'{ticker} - No local data, requesting from API')
-            data = self.request_api_stock_data(ticker)
-            self.save_stock_data_to_local(ticker, data)
-        else:
-            modified_time = pendulum.from_timestamp(file_path.stat().st_mtime)
-            time_diff = pendulum.now().diff(modified_time).minutes
-            logger.info(f'{ticker}: data {time_diff} minutes old')
-            if time_diff > threshold_minutes:
-                logger.info(f'{ticker}: Requesting data from API')
-                data = self.request_api_stock_data(ticker)
-                self.save_stock_data_to_local(ticker, data)
-            else:
+        return orjson.loads(file_path.read_bytes())
+
+    def summarize_stock_data(self, data) -> dict[str, str | float]:
+        quote = data['Global Quote']
+        return {
+            'latest_ts': quote['07. latest trading day'],
+            'latest_close': float(quote['05. price']),
+            'prev_close': float(quote['08. previous close']),
+        }
+
+    def load_stock_summary_from_local(self, ticker) -> dict[str, str | float]:
+        summary_path = pathlib.Path(f'data/{ticker}.summary.json')
+        try:
+            summary = orjson.loads(summary_path.read_bytes())
+        except (FileNotFoundError, orjson.JSONDecodeError):
+            summary = None
+        if not isinstance(summary, dict) or summary.keys() != STOCK_SUMMARY_KEYS:
+            logger.info(f'{ticker}: No valid summary, loading full data from local')
+            summary = self.summarize_stock_data(self.load_stock_data_from_local(ticker))
+        return summary
+
+    def load_local_data_modified_times(self) -> dict[str, float]:
+        # One directory listing instead of an exists() and stat() call per ticker
+        try:
+            with os.scandir('data') as entries:
+                return {
+                    entry.name.removesuffix('.json'): entry.stat().st_mtime
+                    for entry in entries
+                    if entry.name.endswith('.json') and not entry.name.endswith('.summary.json')
+                }
+        except FileNotFoundError:
+            return {}
+
+    def is_local_data_fresh(self, ticker, modified_times: dict[str, float]) -> bool:
+        if (modified_time := modified_times.get(ticker)) is None:
+            logger.info(f'{ticker} - No local data')
+            return False
+        age_seconds = time.time() - modified_time
+        logger.info(f'{ticker}: data {age_seconds / 60:.0f} minutes old')
+        return age_seconds <= self.parameters.threshold_data_age_minutes * 60
+
+    async def _load_or_request_all_summaries(self) -> dict[str, dict[str, str | float]]:
+        import aiohttp
+
+        # Stale tickers are requested from the API concurrently, fresh tickers are loaded from local
+        modified_times = self.load_local_data_modified_times()
+        stale_tickers = [ticker for ticker in self.tickers if not self.is_local_data_fresh(ticker, modified_times)]
+        semaphore = asyncio.Semaphore(ALPHAVANTAGE_MAX_CONCURRENT_REQUESTS)
+        connector = aiohttp.TCPConnector(limit_per_host=ALPHAVANTAGE_MAX_CONCURRENT_REQUESTS)
+        timeout = aiohttp.ClientTimeout(total=ALPHAVANTAGE_TIMEOUT_SECONDS)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            tasks = [self._fetch_api(ticker, session, semaphore) for ticker in stale_tickers]
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        failed_tickers = set()
+        for ticker, result in zip(stale_tickers, results):
+            if isinstance(result, BaseException):
+                logger.error(f'{ticker}: Failed to request data from API: {result!r}')
+                failed_tickers.add(ticker)
+
+        summaries = {}
+        for ticker in self.tickers:
+            if ticker in failed_tickers:
+                if ticker not in modified_times:
+                    continue
+                logger.warning(f'{ticker}: Falling back to stale local data')
+            elif ticker not in stale_tickers:
                 logger.info(f'{ticker}: Loading data from local')
-                data = self.load_stock_data_from_local(ticker)
-        return data
-
-    def load_tickers_from_dynamodb(self) -> dict[str, float]:
-        return {item['ticker']: float(item['threshold']) for item in self.table.scan()['Items']}
+            try:
+                summaries[ticker] = self.load_stock_summary_from_local(ticker)
+            except (FileNotFoundError, KeyError, ValueError):
+                # No local data when the API answered without a quote, or old data saved without one
+                logger.error(f'{ticker}: No usable local data')
+        return summaries
+
+    def scan_tickers_segment(self, segment: int = 0, total_segments: int = 1) -> dict[str, float]:
+        # A single scan call stops at 1 MB, the paginator follows LastEvaluatedKey through every page
+        paginator = self.dynamo_client.get_paginator('scan')
+        pages = paginator.paginate(
+            TableName='stocks',
+            ProjectionExpression='ticker, #t',
+            ExpressionAttributeNames={'#t': 'threshold'},
+            Segment=segment,
+            TotalSegments=total_segments,
+        )
+        return {item['ticker']['S']: float(item['threshold']['N']) for page in pages for item in page['Items']}
+
+    def load_tickers_from_dynamodb(self, total_segments: int = 1) -> dict[str, float]:
+        if total_segments == 1:
+            return self.scan_tickers_segment()
+        tickers = {}
+        with ThreadPoolExecutor(max_workers=total_segments) as executor:
+            segments = executor.map(self.scan_tickers_segment, range(total_segments), [total_segments] * total_segments)
+            for segment_tickers in segments:
+                tickers.update(segment_tickers)
+        return tickers
 
     def save_tickers_to_dynamodb(self, tickers: Sequence[tuple[str, float]]) -> None:
-        for ticker, price_threshold in tickers:
-            self.table.put_item(Item={'ticker': ticker, 'threshold': price_threshold})
-
-    def calculate_investment_dollars(self, account_balance: float, percentage_change: float) -> float:
-        difference = account_balance - self.parameters.target_account_balance
-        percent_over = difference / self.parameters.target_account_balance
-        multiplier = difference * math.exp(percent_over) * self.parameters.investment_aggression
-        dollars = multiplier * abs(percentage_change**2)
-        return dollars
+        put_requests = [
+            {'PutRequest': {'Item': {'ticker': {'S': ticker}, 'threshold': {'N': str(price_threshold)}}}}
+            for ticker, price_threshold in tickers
+        ]
+        for start in range(0, len(put_requests), DYNAMODB_MAX_BATCH_WRITE_ITEMS):
+            end = start + DYNAMODB_MAX_BATCH_WRITE_ITEMS
+            request_items = {'stocks': put_requests[start:end]}
+            # Items DynamoDB could not process in this request are sent again
+            while request_items:
+                response = self.dynamo_client.batch_write_item(RequestItems=request_items)
+                request_items = response['UnprocessedItems']
 
     def check_stock_prices(self):
-        table_data = [
+        from tabulate import SEPARATING_LINE, tabulate
+
+        header = (
             ('[blue]Checking stock prices...[/blue]', ''),
             SEPARATING_LINE,
             ('Account Balance:', f'${self.account_balance:,.2f}'),
@@ -127,23 +279,40 @@ class RoboInvestor:
             ('Aggression (0.0 - 1.0):', f'{self.parameters.investment_aggression:,.2f}'),
             ('Percentage Fall Threshold:', f'{self.parameters.percentage_fall_threshold:,.2f}%'),
             SEPARATING_LINE,
-        ]
-
+        )
+        # Allocate the full table up front and fill it in place by row
+        rows_per_ticker = 7
+        table_data: list = [None] * (len(header) + rows_per_ticker * len(self.tickers))
+        table_data[: len(header)] = header
+        row = len(header)
+
+        # Locals for the values used on every ticker
+        account_balance = self.account_balance
+        target_account_balance = self.parameters.target_account_balance
+        investment_aggression = self.parameters.investment_aggression
+        percentage_fall_threshold = self.parameters.percentage_fall_threshold
+
+        summaries = asyncio.run(self._load_or_request_all_summaries())
         for ticker, price_threshold in self.tickers.items():
-            data = self.load_or_request_data(ticker)
-            latest_data = data['Time Series (5min)']
-            latest_timestamp = max(latest_data.keys())
-            current_price = float(latest_data[latest_timestamp]['4. close'])
-            prev_close_price = float(latest_data[sorted(latest_data.keys())[-2]]['4. close'])
+            if (summary := summaries.get(ticker)) is None:
+                table_data[row] = (f'[red]{ticker}: No data available[/red]', '')
+                table_data[row + 1] = SEPARATING_LINE
+                row += 2
+                continue
+            current_price = summary['latest_close']
+            prev_close_price = summary['prev_close']
             percentage_change = ((current_price - prev_close_price) / prev_close_price) * 100
-            if percentage_change < self.parameters.percentage_fall_threshold:
-                purchase_dollars = self.calculate_investment_dollars(self.account_balance, percentage_change)
+            if percentage_change < percentage_fall_threshold:
+                purchase_dollars = calculate_investment_dollars(
+                    account_balance, target_account_balance, investment_aggression, percentage_change
+                )
                 shares = int(purchase_dollars // current_price)
                 investment_recommendation = f'[green]BUY ${purchase_dollars:,.2f} --> {shares} shares[/green]'
             else:
                 investment_recommendation = '[yellow]HOLD[/yellow]'
 
-            stock_info = [
+            next_row = row + rows_per_ticker
+            table_data[row:next_row] = (
                 (f'[green]{ticker}[/green]', ''),
                 ('Current Price:', f'${current_price:,.2f}'),
                 ('Threshold:', f'${price_threshold:,.2f}'),
@@ -151,12 +320,21 @@ class RoboInvestor:
                 ('Percentage Change:', f'{percentage_change:,.2f}%'),
                 (investment_recommendation, ''),
                 SEPARATING_LINE,
-            ]
-            table_data.extend(stock_info)
+            )
+            row = next_row
 
+        # Tickers without data use fewer rows, drop the unused tail
+        del table_data[row:]
         print(tabulate(table_data, tablefmt='plain'))
 
 
+@functools.cache
+def get_boto_session() -> 'boto3.Session':
+    import boto3
+
+    return boto3.Session(profile_name='chris.birch.developer@ichrisbirch')
+
+
 @app.callback(invoke_without_command=True)
 @app.command()
 def check(
@@ -180,32 +358,23 @@ def check(
     if ctx.invoked_subcommand is not None:
         return
 
-    boto_session = boto3.Session(profile_name='chris.birch.developer@ichrisbirch')
-    rbi = RoboInvestor(boto_session)
+    rbi = RoboInvestor(get_boto_session())
 
     if account_balance:
         rbi.account_balance = account_balance
 
+    new_parameters = {
+        'target_account_balance': target_balance,
+        'threshold_data_age_minutes': threshold_minutes,
+        'investment_aggression': investment_aggression,
+        'percentage_fall_threshold': percentage_fall_threshold,
+    }
+    new_parameters = {name: value for name, value in new_parameters.items() if value}
+
     # Save parameters which will be loaded
-    if target_balance:
-        logger.info(f'Setting target account balance to {target_balance}')
-        rbi.save_parameters_to_parameter_store({'target_account_balance': str(target_balance)})
-        rbi.parameters.target_account_balance = target_balance
-
-    if threshold_minutes:
-        logger.info(f'Setting threshold data age to {threshold_minutes} minutes')
-        rbi.save_parameters_to_parameter_store({'threshold_data_age_minutes': str(threshold_minutes)})
-        rbi.parameters.threshold_data_age_minutes = threshold_minutes
-
-    if investment_aggression:
-        logger.info(f'Setting investment aggression to {investment_aggression}')
-        rbi.save_parameters_to_parameter_store({'investment_aggression': str(investment_aggression)})
-        rbi.parameters.investment_aggression = investment_aggression
-
-    if percentage_fall_threshold:
-        logger.info(f'Setting percentage fall threshold to {percentage_fall_threshold}')
-        rbi.save_parameters_to_parameter_store({'percentage_fall_threshold': str(percentage_fall_threshold)})
-        rbi.parameters.percentage_fall_threshold = percentage_fall_threshold
+    if new_parameters:
+        rbi.save_parameters_to_parameter_store({name: str(value) for name, value in new_parameters.items()})
+        rbi.parameters = replace(rbi.parameters, **new_parameters)
 
     rbi.check_stock_prices()
 
@@ -1,15 +1,24 @@
+import multiprocessing as mp
+
+import numpy as np
 import pandas as pd
 
+TIME_PERIODS = [1, 7, 30, 90, 180, 365, 3 * 365, 5 * 365, 10 * 365]  # Time periods in days
+
 
 # Load historical price data into a DataFrame
 def load_data(file_path):
-    data = pd.read_csv(file_path, parse_dates=['Date'])
+    data = pd.read_csv(file_path, parse_dates=['Date'], engine='pyarrow')
+    data['Ticker'] = data['Ticker'].astype('category')
     return data
 
 
-# Calculate percentage change over different time periods
-def calculate_percentage_change(data, time_period):
-    return data['Close'].pct_change(periods=time_period) * 100
+# Latest percentage change of an array of closing prices over a period
+def latest_pct_change(close, period):
+    if period >= close.shape[0]:
+        return np.nan
+    previous = close[-1 - period]
+    return (close[-1] - previous) / previous * 100
 
 
 # Calculate likelihood and investment percentage
@@ -24,30 +33,33 @@ def calculate_likelihood_and_percentage_change(percentage_change):
     return likelihood, investment_percentage
 
 
+# Analyze a single ticker, run in a worker process
+def analyze_ticker(args):
+    ticker, stock_data = args
+    close = stock_data['Close'].to_numpy(dtype=np.float64)
+
+    lines = [f"Stock: {ticker}"]
+    for period in TIME_PERIODS:
+        last_change = latest_pct_change(close, period)
+        likelihood, investment_percentage = calculate_likelihood_and_percentage_change(last_change)
+        lines.append(
+            f'For {period}-day period: Likelihood: {likelihood:.4f}, '
+            f'Investment Percentage: {investment_percentage:.2f}%'
+        )
+    lines.append("=" * 40)
+    return '\n'.join(lines)
+
+
 # Main function
 def main():
     file_path = 'historical_stock_data.csv'
     data = load_data(file_path)
+    data = data.sort_values(['Ticker', 'Date'])
 
-    time_periods = [1, 7, 30, 90, 180, 365, 3 * 365, 5 * 365, 10 * 365]  # Time periods in days
-
-    stock_tickers = data['Ticker'].unique()
-
-    for ticker in stock_tickers:
-        stock_data = data[data['Ticker'] == ticker]
-
-        print(f"Stock: {ticker}")
-        for period in time_periods:
-            percentage_changes = calculate_percentage_change(stock_data, period)
-            last_change = percentage_changes.iloc[-1]  # Get the latest percentage change
-            likelihood, investment_percentage = calculate_likelihood_and_percentage_change(last_change)
-
-            print(
-                f'For {period}-day period: Likelihood: {likelihood:.4f}, '
-                f'Investment Percentage: {investment_percentage:.2f}%'
-            )
-
-        print("=" * 40)
+    # Each worker gets the contiguous, date sorted rows of one ticker
+    with mp.Pool() as pool:
+        for result in pool.imap(analyze_ticker, data.groupby('Ticker', observed=True)):
+            print(result)
 
 
 if __name__ == "__main__":